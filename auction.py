@@ -1,6 +1,9 @@
 
+import json
 import logging
+import os
 import sqlite3
+import time
 from datetime import datetime, timedelta
 from enum import Enum
 
@@ -8,10 +11,172 @@ class Valuta(Enum):
     Pokédollari = "₽"
 
 
+class BidJournal:
+    """Journal append-only delle offerte accettate, con fsync a gruppi."""
+
+    def __init__(self, path, group_size=16, group_interval=0.2):
+        self.path = path
+        self.group_size = group_size
+        self.group_interval = group_interval
+        self.entries = 0
+        self._pending = 0
+        self._last_sync = time.monotonic()
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def append(self, auction_id, bid, user_id):
+        # flush() consegna la riga al sistema operativo (sopravvive al crash del processo),
+        # fsync() la porta su disco ed è raggruppato per non pagarlo a ogni click
+        self._file.write(json.dumps([auction_id, bid, user_id]) + "\n")
+        self._file.flush()
+        self.entries += 1
+        self._pending += 1
+        if self._pending >= self.group_size or time.monotonic() - self._last_sync >= self.group_interval:
+            self.sync()
+
+    def sync(self):
+        if self._pending:
+            os.fsync(self._file.fileno())
+            self._pending = 0
+        self._last_sync = time.monotonic()
+
+    def truncate(self):
+        """Svuota il journal dopo un checkpoint su SQLite."""
+        self._file.seek(0)
+        self._file.truncate()
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.entries = 0
+        self._pending = 0
+
+    def close(self):
+        self.sync()
+        self._file.close()
+
+    @staticmethod
+    def read(path) -> list[tuple]:
+        """Legge le offerte registrate, ignorando un'eventuale ultima riga troncata."""
+        if not os.path.exists(path):
+            return []
+        bids = []
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                try:
+                    auction_id, bid, user_id = json.loads(line)
+                except ValueError:
+                    break
+                bids.append((auction_id, bid, user_id))
+        return bids
+
+
 class AuctionDB:
     DB_PATH = 'auction_bot.db'
+    LEADERBOARDS = {
+        "medaglie": "medal_count",
+        "vittorie": "auctions_won",
+        "spesa": "total_paid",
+    }
+    BID_JOURNAL_PATH = 'bid_journal.log'
+    CHECKPOINT_EVERY = 50
+    JOURNAL_SYNC_INTERVAL = 0.2
+    # I gift non scadono: in memoria si tengono solo gli ultimi, gli altri si verificano su SQLite
+    OPEN_GIFTS = 20
+
+    # Stato in memoria, popolato da warm_start(); finché _warm è False si legge da SQLite
+    _warm = False
+    _journal = None
+    _auctions = {}      # auction_id -> [id, card_name, last_bid, user_id, message_id]
+    _users = {}         # user_id -> [user_name, wallet]
+    _gift_claims = {}   # gift_id -> {user_id, ...}, solo per gli ultimi OPEN_GIFTS gift
+    _dirty_bids = set()
 
-    
+    @staticmethod
+    def warm_start() -> dict:
+        """Recupera le offerte dal journal e carica in memoria aste attive, gift e utenti coinvolti."""
+        start = time.perf_counter()
+        bids = BidJournal.read(AuctionDB.BID_JOURNAL_PATH)
+
+        conn = sqlite3.connect(AuctionDB.DB_PATH)
+        cursor = conn.cursor()
+
+        # Le offerte sono crescenti: riapplicarle è idempotente
+        for auction_id, bid, user_id in bids:
+            cursor.execute(
+                "UPDATE active_auctions SET last_bid = ?, user_id = ? WHERE id = ? AND last_bid < ?",
+                (bid, user_id, auction_id, bid)
+            )
+        conn.commit()
+
+        auctions = cursor.execute(
+            "SELECT id, card_name, last_bid, user_id, message_id FROM active_auctions"
+        ).fetchall()
+        gifts = [row[0] for row in cursor.execute(
+            "SELECT DISTINCT gift_id FROM gift_claims WHERE user_id IS NULL ORDER BY gift_id DESC LIMIT ?",
+            (AuctionDB.OPEN_GIFTS,)
+        ).fetchall()]
+        placeholders = ", ".join("?" * len(gifts))
+        claims = cursor.execute(
+            f"SELECT gift_id, user_id FROM gift_claims WHERE user_id IS NOT NULL AND gift_id IN ({placeholders})",
+            gifts
+        ).fetchall()
+        users = cursor.execute(f"""
+            SELECT user_id, user_name, wallet FROM users
+            WHERE user_id IN (SELECT CAST(user_id AS INTEGER) FROM active_auctions WHERE user_id IS NOT NULL)
+               OR user_id IN (SELECT user_id FROM gift_claims WHERE user_id IS NOT NULL AND gift_id IN ({placeholders}))
+            """, gifts
+        ).fetchall()
+        conn.close()
+
+        AuctionDB._auctions = {row[0]: list(row) for row in auctions}
+        AuctionDB._gift_claims = {int(gift_id): set() for gift_id in gifts}
+        for gift_id, user_id in claims:
+            AuctionDB._gift_claims[int(gift_id)].add(int(user_id))
+        AuctionDB._users = {int(user_id): [name, wallet] for user_id, name, wallet in users}
+        AuctionDB._dirty_bids = set()
+
+        # Il replay è già su SQLite: il journal riparte vuoto
+        AuctionDB._journal = BidJournal(AuctionDB.BID_JOURNAL_PATH, group_interval=AuctionDB.JOURNAL_SYNC_INTERVAL)
+        AuctionDB._journal.truncate()
+        AuctionDB._warm = True
+
+        return {
+            "replayed": len(bids),
+            "auctions": len(auctions),
+            "users": len(users),
+            "gifts": len(gifts),
+            "gift_claims": len(claims),
+            "seconds": time.perf_counter() - start,
+        }
+
+    @staticmethod
+    def checkpoint():
+        """Scrive su SQLite le offerte tenute in memoria e svuota il journal."""
+        if not AuctionDB._dirty_bids:
+            return
+        conn = sqlite3.connect(AuctionDB.DB_PATH)
+        cursor = conn.cursor()
+        cursor.executemany(
+            "UPDATE active_auctions SET last_bid = ?, user_id = ? WHERE id = ?",
+            [(AuctionDB._auctions[auction_id][2], AuctionDB._auctions[auction_id][3], auction_id)
+             for auction_id in AuctionDB._dirty_bids if auction_id in AuctionDB._auctions]
+        )
+        conn.commit()
+        conn.close()
+        AuctionDB._dirty_bids.clear()
+        AuctionDB._journal.truncate()
+
+    @staticmethod
+    def sync_journal():
+        """Porta su disco le offerte rimaste senza fsync dopo l'ultima raffica."""
+        if AuctionDB._warm:
+            AuctionDB._journal.sync()
+
+    @staticmethod
+    def shutdown():
+        """Checkpoint finale e chiusura del journal."""
+        if AuctionDB._warm:
+            AuctionDB.checkpoint()
+            AuctionDB._journal.close()
+            AuctionDB._warm = False
 
     @staticmethod
     def initialize_db():
@@ -48,11 +213,44 @@ class AuctionDB:
                             emoji TEXT,
                             name TEXT,
                             PRIMARY KEY (user_id, emoji, name));''')
-    
+
+        # Aggregati per utente, aggiornati insieme a medaglie e chiusura delle aste
+        user_stats_exists = cursor.execute(
+            "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'user_stats'"
+        ).fetchone()
+        cursor.execute('''CREATE TABLE IF NOT EXISTS user_stats (
+                            user_id       INTEGER PRIMARY KEY,
+                            medal_count   INTEGER NOT NULL DEFAULT 0,
+                            medal_emojis  TEXT    NOT NULL DEFAULT '',
+                            auctions_won  INTEGER NOT NULL DEFAULT 0,
+                            total_paid    INTEGER NOT NULL DEFAULT 0)''')
+        for column in AuctionDB.LEADERBOARDS.values():
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_user_stats_{column} ON user_stats ({column} DESC)")
+        if not user_stats_exists:
+            AuctionDB._rebuild_user_stats(cursor)
 
         conn.commit()
         conn.close()
 
+    @staticmethod
+    def _rebuild_user_stats(cursor):
+        """Ricalcola da zero gli aggregati a partire da medals e archived_auctions."""
+        cursor.execute("DELETE FROM user_stats")
+        cursor.execute('''
+            INSERT INTO user_stats (user_id, medal_count, medal_emojis)
+            SELECT CAST(user_id AS INTEGER), COUNT(*), GROUP_CONCAT(emoji, ' ')
+            FROM medals
+            GROUP BY CAST(user_id AS INTEGER)''')
+        cursor.execute('''
+            INSERT INTO user_stats (user_id, auctions_won, total_paid)
+            SELECT user_id, COUNT(*), SUM(paid)
+            FROM archived_auctions
+            WHERE paid > 0
+            GROUP BY user_id
+            ON CONFLICT(user_id) DO UPDATE SET
+                auctions_won = excluded.auctions_won,
+                total_paid = excluded.total_paid''')
+
     @staticmethod
     def add_active_auction(card_name, message_id):
         conn = sqlite3.connect(AuctionDB.DB_PATH)
@@ -61,11 +259,24 @@ class AuctionDB:
             "INSERT INTO active_auctions (card_name, last_bid, user_id, message_id) VALUES (?, ?, ?, ?)",
             (card_name, 0, None, message_id)
         )
+        auction_id = cursor.lastrowid
         conn.commit()
         conn.close()
+        if AuctionDB._warm:
+            AuctionDB._auctions[auction_id] = [auction_id, card_name, 0, None, message_id]
 
     @staticmethod
     def update_bid(auction_id, new_bid, user_id):
+        if AuctionDB._warm:
+            # L'offerta vive in memoria e nel journal fino al prossimo checkpoint
+            auction = AuctionDB._auctions[auction_id]
+            auction[2], auction[3] = new_bid, user_id
+            AuctionDB._journal.append(auction_id, new_bid, user_id)
+            AuctionDB._dirty_bids.add(auction_id)
+            if AuctionDB._journal.entries >= AuctionDB.CHECKPOINT_EVERY:
+                AuctionDB.checkpoint()
+            return
+
         conn = sqlite3.connect(AuctionDB.DB_PATH)
         cursor = conn.cursor()
         cursor.execute(
@@ -83,6 +294,15 @@ class AuctionDB:
             "INSERT OR IGNORE INTO medals (user_id, emoji, name) VALUES (?, ?, ?)", 
             (user_id, emoji, name)
         )
+        if cursor.rowcount:
+            cursor.execute('''
+                INSERT INTO user_stats (user_id, medal_count, medal_emojis) VALUES (?, 1, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    medal_count = medal_count + 1,
+                    medal_emojis = CASE WHEN medal_emojis = '' THEN excluded.medal_emojis
+                                        ELSE medal_emojis || ' ' || excluded.medal_emojis END''',
+                (int(user_id), emoji)
+            )
         conn.commit()
         conn.close()
     
@@ -102,10 +322,11 @@ class AuctionDB:
         conn = sqlite3.connect(AuctionDB.DB_PATH)
         cursor = conn.cursor()
         summary = cursor.execute("""
-            SELECT u.user_name, COUNT(m.emoji), GROUP_CONCAT(m.emoji, ' ') 
-            FROM medals m
-            JOIN users u ON m.user_id = u.user_id
-            GROUP BY u.user_name
+            SELECT u.user_name, s.medal_count, s.medal_emojis
+            FROM user_stats s
+            JOIN users u ON s.user_id = u.user_id
+            WHERE s.medal_count > 0
+            ORDER BY s.medal_count DESC
         """).fetchall()
         conn.close()
         return summary
@@ -115,6 +336,9 @@ class AuctionDB:
     @staticmethod
     def end_auction(auction_id: int) -> str:
         """Termina l'asta specificata e determina il vincitore, se presente."""
+        if AuctionDB._warm:
+            AuctionDB.checkpoint()
+
         conn = sqlite3.connect(AuctionDB.DB_PATH)
         cursor = conn.cursor()
 
@@ -143,11 +367,35 @@ class AuctionDB:
 
             # Aggiorna il saldo dell'utente vincitore nella tabella users
             cursor.execute("UPDATE users SET wallet = wallet - ? WHERE user_id = ?", (last_bid, user_id))
+            cursor.execute(
+                "INSERT INTO user_stats (user_id, auctions_won, total_paid) VALUES (?, 1, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET auctions_won = auctions_won + 1, total_paid = total_paid + excluded.total_paid",
+                (int(user_id), last_bid)
+            )
+            AuctionDB._users.pop(int(user_id), None)
 
         conn.commit()
         conn.close()
         return result
 
+    @staticmethod
+    def get_leaderboard(kind: str, limit: int = 10, offset: int = 0) -> list[tuple]:
+        """Classifica paginata (user_name, valore) letta dagli aggregati di user_stats."""
+        column = AuctionDB.LEADERBOARDS[kind]
+        conn = sqlite3.connect(AuctionDB.DB_PATH)
+        cursor = conn.cursor()
+        rows = cursor.execute(f"""
+            SELECT u.user_name, s.{column}
+            FROM user_stats s
+            JOIN users u ON s.user_id = u.user_id
+            WHERE s.{column} > 0
+            ORDER BY s.{column} DESC, s.user_id
+            LIMIT ? OFFSET ?
+            """, (limit, offset)
+        ).fetchall()
+        conn.close()
+        return rows
+
     @staticmethod
     def archive_auction(auction_id):
         """Archivia l'asta con l'ID specificato."""
@@ -161,9 +409,18 @@ class AuctionDB:
         cursor.execute("DELETE FROM active_auctions WHERE id = ?", (auction_id,))
         conn.commit()
         conn.close()
+        AuctionDB._auctions.pop(auction_id, None)
+        AuctionDB._dirty_bids.discard(auction_id)
 
     @staticmethod
     def get_active_auctions(message_id=None):
+        if AuctionDB._warm:
+            return [
+                (auction_id, card_name, last_bid, user_id)
+                for auction_id, card_name, last_bid, user_id, msg_id in sorted(AuctionDB._auctions.values())
+                if message_id is None or str(msg_id) == str(message_id)
+            ]
+
         conn = sqlite3.connect(AuctionDB.DB_PATH)
         cursor = conn.cursor()
         
@@ -185,6 +442,12 @@ class AuctionDB:
     @staticmethod
     def get_auction_by_card_name(card_name: str):
         """Ottiene i dettagli di un'asta attiva in base al nome della carta."""
+        if AuctionDB._warm:
+            for auction_id, name, last_bid, _, _ in sorted(AuctionDB._auctions.values()):
+                if name == card_name:
+                    return auction_id, last_bid
+            return None
+
         conn = sqlite3.connect(AuctionDB.DB_PATH)
         cursor = conn.cursor()
         cursor.execute(
@@ -198,15 +461,7 @@ class AuctionDB:
     
     @staticmethod
     def name_of_user(id):
-        conn = sqlite3.connect(AuctionDB.DB_PATH)
-        cursor = conn.cursor()
-        user_name = cursor.execute(
-            "SELECT user_name FROM users WHERE user_id = ?",
-            (id,)
-        ).fetchone()
-        conn.commit()
-        conn.close()
-        return user_name[0]
+        return AuctionDB._cached_user(id)[0]
 
     
     @staticmethod
@@ -223,14 +478,28 @@ class AuctionDB:
 
     @staticmethod
     def get_user_balance(user_id):
+        user = AuctionDB._cached_user(user_id)
+        return user[1] if user is not None else None
+
+    @staticmethod
+    def _cached_user(user_id):
+        """Restituisce [user_name, wallet] dalla memoria, caricandolo da SQLite se manca."""
+        if AuctionDB._warm and int(user_id) in AuctionDB._users:
+            return AuctionDB._users[int(user_id)]
+
         conn = sqlite3.connect(AuctionDB.DB_PATH)
         cursor = conn.cursor()
         row = cursor.execute(
-            "SELECT wallet FROM users WHERE user_id = ?",
+            "SELECT user_name, wallet FROM users WHERE user_id = ?",
             (user_id,)
         ).fetchone()
         conn.close()
-        return row[0] if row else None
+        if row is None:
+            return None
+        user = list(row)
+        if AuctionDB._warm:
+            AuctionDB._users[int(user_id)] = user
+        return user
 
 
     @staticmethod
@@ -243,6 +512,8 @@ class AuctionDB:
 
         conn.commit()
         conn.close()
+        if int(user_id) in AuctionDB._users:
+            AuctionDB._users[int(user_id)][1] = amount
 
     @staticmethod
     def add_gift(gift_id):
@@ -251,16 +522,28 @@ class AuctionDB:
         cursor.execute("INSERT OR IGNORE INTO gift_claims (gift_id) VALUES (?)", (gift_id,))
         conn.commit()
         conn.close()
+        if AuctionDB._warm:
+            AuctionDB._gift_claims[int(gift_id)] = set()
+            if len(AuctionDB._gift_claims) > AuctionDB.OPEN_GIFTS:
+                del AuctionDB._gift_claims[min(AuctionDB._gift_claims)]
 
     # Funzione per riscattare il gift
     @staticmethod
     def claim_gift(gift_id, user_id):
+        # Per i gift in memoria l'insieme delle riscossioni è completo e basta a decidere
+        claimed_by = AuctionDB._gift_claims.get(int(gift_id))
+        if claimed_by is not None and int(user_id) in claimed_by:
+            return False  # Già riscosso
+
         conn = sqlite3.connect(AuctionDB.DB_PATH)
         cursor = conn.cursor()
 
         # Controlla se l'utente ha già riscosso il gift
-        cursor.execute("SELECT 1 FROM gift_claims WHERE gift_id = ? AND user_id = ?", (gift_id, user_id))
-        already_claimed = cursor.fetchone()
+        if claimed_by is None:
+            cursor.execute("SELECT 1 FROM gift_claims WHERE gift_id = ? AND user_id = ?", (gift_id, user_id))
+            already_claimed = cursor.fetchone()
+        else:
+            already_claimed = False
 
         if already_claimed:
             conn.close()
@@ -270,6 +553,8 @@ class AuctionDB:
         cursor.execute("INSERT INTO gift_claims (gift_id, user_id) VALUES (?, ?)", (gift_id, user_id))
         conn.commit()
         conn.close()
+        if claimed_by is not None:
+            claimed_by.add(int(user_id))
         return True  # Riscossione riuscita
     
 
@@ -309,4 +594,6 @@ class AuctionDB:
         
         conn.commit()
         conn.close()
+        if AuctionDB._warm:
+            AuctionDB._users.setdefault(int(user_id), [username, new_balance])[1] = new_balance
         return new_balance
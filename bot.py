@@ -1,7 +1,9 @@
+import asyncio
 import logging
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Chat
 from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters, ContextTypes, CallbackContext
 from auction import AuctionDB, Valuta
+from profiling import profiler, profiled
 from functools import wraps
 from telegram import Update
 from telegram.ext import ContextTypes
@@ -22,6 +24,7 @@ user_state = {}
 
 
 
+@profiled
 @authorized_only
 async def start_auction(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     photo = update.message.photo[-1].file_id
@@ -59,6 +62,7 @@ def bid_message_builder(auctions:list[3]):
     message_text += "Premi sotto per fare un'offerta"
     return message_text,keyboard
 
+@profiled
 async def handle_offer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     user = query.from_user
@@ -94,6 +98,7 @@ async def handle_offer(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
     except TimeoutError as e:
         logging.getLogger().error(f"TimedOut error @auction {auction_id} from {username}: {e}")
 
+@profiled
 @authorized_only
 async def set_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if len(context.args) < 2:
@@ -114,6 +119,7 @@ async def set_wallet(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
 
 
 
+@profiled
 async def check_balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Risponde all'utente con il saldo corrente delle sue monete."""
     user_id = update.message.from_user.id
@@ -129,6 +135,7 @@ async def check_balance(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 
 
 
+@profiled
 @authorized_only
 async def saldo_totale_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # Recupera tutti i saldi degli utenti
@@ -141,6 +148,7 @@ async def saldo_totale_handler(update: Update, context: ContextTypes.DEFAULT_TYP
 
 
 
+@profiled
 @authorized_only
 async def give_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if len(context.args) < 2:
@@ -181,6 +189,7 @@ def auction_results_builder(auctions):
     return "\n".join(results) if results else "Sembra che quest'asta fosse già chiusa, o non era proprio un'asta boh."
 
 
+@profiled
 @authorized_only
 async def add_medal_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if len(context.args) < 3:
@@ -215,6 +224,7 @@ async def add_medal_handler(update: Update, context: ContextTypes.DEFAULT_TYPE)
             parse_mode="Markdown",
         )
 
+@profiled
 @authorized_only
 async def medals_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if context.args:  
@@ -246,6 +256,41 @@ async def medals_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 
 
+@profiled
+@authorized_only
+async def leaderboard_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Mostra la classifica richiesta, 10 posizioni per pagina."""
+    PAGE_SIZE = 10
+    MAX_PAGE = 1000
+    kinds = "|".join(AuctionDB.LEADERBOARDS)
+    kind = context.args[0].lower() if context.args else "medaglie"
+    page = 1
+    if len(context.args) > 1:
+        # isdecimal() esclude cifre come "²" che passerebbero isdigit() ma non int()
+        try:
+            page = int(context.args[1]) if context.args[1].isdecimal() else None
+        except ValueError:
+            page = None
+    if kind not in AuctionDB.LEADERBOARDS or page is None:
+        await update.message.reply_text(f"Utilizzo: /classifica [{kinds}] [pagina]")
+        return
+
+    # Il limite tiene l'OFFSET dentro gli interi di SQLite
+    page = min(max(page, 1), MAX_PAGE)
+    offset = (page - 1) * PAGE_SIZE
+    rows = AuctionDB.get_leaderboard(kind, PAGE_SIZE, offset)
+    if not rows:
+        await update.message.reply_text(f"Nessuno in classifica {kind} a pagina {page}.")
+        return
+
+    unit = Valuta.Pokédollari.value if kind == "spesa" else ""
+    message = f"Classifica {kind} (pagina {page})\n"
+    message += "\n".join(f"{offset + i}. {username}: {value}{unit}" for i, (username, value) in enumerate(rows, start=1))
+    await update.message.reply_text(message)
+
+
+
+@profiled
 @authorized_only
 async def end_auction_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     # Controlla se il comando è una risposta a un messaggio di apertura dell'asta
@@ -258,12 +303,14 @@ async def end_auction_handler(update: Update, context: ContextTypes.DEFAULT_TYPE
     await update.message.reply_to_message.reply_text(results_message)
 
 
+@profiled
 @authorized_only
 async def end_all_auctions(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     auctions = AuctionDB.get_active_auctions()
     results_message = auction_results_builder(auctions)
     await context.bot.send_message(chat_id=GROUP_ID, text=results_message)
 
+@profiled
 @authorized_only
 async def gift(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if len(context.args) != 1 or not context.args[0].isdigit():
@@ -287,6 +334,7 @@ async def gift(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     gift_id = sent_message.message_id
     AuctionDB.add_gift(gift_id)
 
+@profiled
 async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     user_id = query.from_user.id
@@ -311,6 +359,7 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         logging.getLogger().error("Timedout")
 
 
+@profiled
 async def info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Risponde con tutte le informazioni del messaggio inviato."""
 
@@ -355,6 +404,67 @@ async def info(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 
 
+@authorized_only
+async def profile_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Attiva la profilazione per i prossimi N aggiornamenti o per T secondi, oppure la interrompe."""
+    arg = context.args[0].lower() if context.args else "20"
+    if arg == "stop":
+        if not profiler.active:
+            await update.message.reply_text("Nessuna profilazione in corso.")
+            return
+        await update.message.reply_text("Profilazione interrotta, invio il riepilogo.")
+        await profiler.stop(context.bot)
+        return
+
+    if profiler.active:
+        await update.message.reply_text("Profilazione già in corso. Usa /profile stop per interromperla.")
+        return
+
+    try:
+        if arg.endswith("s"):
+            seconds, updates = int(arg[:-1]), None
+        else:
+            seconds, updates = None, int(arg)
+    except ValueError:
+        seconds, updates = None, None
+    window = seconds if seconds is not None else updates
+    if window is None or window <= 0:
+        await update.message.reply_text("Utilizzo: /profile [aggiornamenti] oppure /profile [secondi]s oppure /profile stop")
+        return
+
+    profiler.start(update.effective_chat.id, context.bot, updates=updates, seconds=seconds)
+    if seconds:
+        await update.message.reply_text(f"Profilazione attiva per {seconds} secondi.")
+    else:
+        await update.message.reply_text(f"Profilazione attiva per i prossimi {updates} aggiornamenti.")
+
+
+
+journal_sync_task = None
+
+async def journal_sync_loop() -> None:
+    # Senza questo, l'ultima offerta di una raffica resterebbe senza fsync fino al click successivo
+    while True:
+        await asyncio.sleep(AuctionDB.JOURNAL_SYNC_INTERVAL)
+        AuctionDB.sync_journal()
+
+
+async def post_init(application: Application) -> None:
+    # Task asyncio semplice: Application.create_task qui avviserebbe che l'app non è ancora avviata
+    global journal_sync_task
+    journal_sync_task = asyncio.create_task(journal_sync_loop())
+
+
+
+async def post_stop(application: Application) -> None:
+    # Ferma il sync prima che main() esegua il checkpoint di AuctionDB.shutdown()
+    if journal_sync_task is not None:
+        journal_sync_task.cancel()
+        await asyncio.gather(journal_sync_task, return_exceptions=True)
+    await profiler.shutdown()
+
+
+
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     logging.getLogger().error(msg="Exception:", exc_info=context.error)
 
@@ -378,7 +488,12 @@ def main() -> None:
     logging.info("Bot avviato")
 
     AuctionDB.initialize_db()
-    application = Application.builder().token(TOKEN).concurrent_updates(5).build()
+    stats = AuctionDB.warm_start()
+    logging.getLogger().warning(
+        f"Avvio a caldo in {stats['seconds'] * 1000:.1f}ms: {stats['auctions']} aste, "
+        f"{stats['users']} utenti, {stats['gifts']} gift aperti ({stats['gift_claims']} riscossioni), {stats['replayed']} offerte recuperate dal journal"
+    )
+    application = Application.builder().token(TOKEN).concurrent_updates(5).post_init(post_init).post_stop(post_stop).build()
 
     application.add_handler(CommandHandler("deposito", set_wallet))
     application.add_handler(CommandHandler("termina", end_auction_handler))  
@@ -388,7 +503,9 @@ def main() -> None:
     application.add_handler(CommandHandler("saldo", check_balance))
     application.add_handler(CommandHandler("medaglia", add_medal_handler))
     application.add_handler(CommandHandler("medaglie", medals_handler))
+    application.add_handler(CommandHandler("classifica", leaderboard_handler))
     application.add_handler(CommandHandler("saldototale", saldo_totale_handler))
+    application.add_handler(CommandHandler("profile", profile_handler))
 
 
     application.add_handler(CallbackQueryHandler(button, pattern="^gift_"))
@@ -398,7 +515,10 @@ def main() -> None:
 
     application.add_error_handler(error_handler)
 
-    application.run_polling()
+    try:
+        application.run_polling()
+    finally:
+        AuctionDB.shutdown()
 
 if __name__ == "__main__":
     main()
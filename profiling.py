@@ -0,0 +1,175 @@
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import tempfile
+import time
+import tracemalloc
+from functools import wraps
+from telegram import Update
+from telegram.ext import ContextTypes
+
+
+class UpdateProfiler:
+    """Profilazione a finestra: cProfile sugli handler e diff di tracemalloc."""
+
+    TOP_N = 15
+    # Il profilo resta acceso attraverso gli await: questi frame misurano l'attesa di rete, non gli handler
+    EVENT_LOOP_FILES = (f"{os.sep}asyncio{os.sep}", f"{os.sep}selectors.py")
+    EVENT_LOOP_BUILTINS = ("<method 'poll' ", "<method 'select' ", "<method 'control' ",
+                           "<method 'run' of '_contextvars.Context'")
+
+    def __init__(self):
+        self.active = False
+        self._closing = False
+        self._profile = None
+        self._running = 0
+        self._remaining = None
+        self._deadline = None
+        self._chat_id = None
+        self._snapshot = None
+        self._handler_times = {}
+        self._expiry = None
+
+    def start(self, chat_id, bot, updates=None, seconds=None):
+        self.active = True
+        self._closing = False
+        self._profile = cProfile.Profile()
+        self._running = 0
+        self._remaining = updates
+        self._deadline = time.monotonic() + seconds if seconds else None
+        self._chat_id = chat_id
+        self._handler_times = {}
+        tracemalloc.start()
+        self._snapshot = tracemalloc.take_snapshot()
+        # Task asyncio semplice, non tracciato da PTB: non deve trattenere lo stop dell'applicazione
+        if seconds:
+            self._expiry = asyncio.create_task(self.expire_after(seconds, bot))
+
+    def profiled(self, func):
+        """Decoratore per gli handler: a profilazione spenta costa un solo controllo."""
+        @wraps(func)
+        async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE, *args, **kwargs):
+            if not self.active or not self._admit():
+                return await func(update, context, *args, **kwargs)
+
+            # Un solo profiler per volta: resta acceso finché c'è almeno un handler in corso
+            if self._running == 0:
+                self._profile.enable()
+            self._running += 1
+            start = time.perf_counter()
+            try:
+                return await func(update, context, *args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - start
+                calls, total = self._handler_times.get(func.__name__, (0, 0.0))
+                self._handler_times[func.__name__] = (calls + 1, total + elapsed)
+                self._running -= 1
+                if self._running == 0:
+                    self._profile.disable()
+                if self._closing:
+                    await self.finish(context.bot)
+        return wrapper
+
+    def _admit(self):
+        """Decide all'ingresso se l'aggiornamento entra nella finestra."""
+        if self._closing:
+            return False
+        if self._deadline is not None and time.monotonic() >= self._deadline:
+            self._closing = True
+            return False
+        if self._remaining is not None:
+            self._remaining -= 1
+            # L'ultimo aggiornamento ammesso chiude la finestra: il riepilogo parte quando termina
+            self._closing = self._remaining <= 0
+        return True
+
+    async def expire_after(self, seconds, bot):
+        await asyncio.sleep(seconds)
+        await self.stop(bot)
+
+    async def shutdown(self):
+        """Annulla la scadenza in sospeso, da chiamare alla chiusura del bot."""
+        expiry, self._expiry = self._expiry, None
+        if expiry is not None:
+            expiry.cancel()
+            await asyncio.gather(expiry, return_exceptions=True)
+
+    async def stop(self, bot):
+        """Chiude la finestra in anticipo; se un handler è in corso, il riepilogo parte quando termina."""
+        if not self.active:
+            return
+        self._closing = True
+        await self.finish(bot)
+
+    def _is_event_loop(self, filename, line, func):
+        return any(part in filename for part in self.EVENT_LOOP_FILES) or func.startswith(self.EVENT_LOOP_BUILTINS)
+
+    async def finish(self, bot):
+        """Chiude la finestra e invia il riepilogo con il file .pstats."""
+        if not self.active or self._running:
+            return
+        # Lo stato della finestra passa in locali prima di qualsiasi await:
+        # un nuovo /profile durante l'invio del riepilogo non deve essere toccato
+        self.active = False
+        self._closing = False
+        profile, chat_id, handler_times, start_snapshot = (
+            self._profile, self._chat_id, self._handler_times, self._snapshot
+        )
+        self._profile, self._chat_id, self._handler_times, self._snapshot = None, None, {}, None
+        expiry, self._expiry = self._expiry, None
+        if expiry is not None and expiry is not asyncio.current_task():
+            expiry.cancel()
+        snapshot = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        memory = snapshot.compare_to(start_snapshot, 'lineno')[:self.TOP_N]
+
+        stream = io.StringIO()
+        try:
+            stats = pstats.Stats(profile, stream=stream)
+        except TypeError:
+            # Nessuna chiamata registrata nella finestra
+            stats = None
+        if stats:
+            stats.sort_stats("cumulative").print_stats(self.TOP_N)
+
+        message = "Profilazione terminata\n\nHandler (chiamate, tempo totale):\n"
+        message += "\n".join(
+            f"{name}: {calls}x, {total * 1000:.1f}ms"
+            for name, (calls, total) in sorted(handler_times.items(), key=lambda item: -item[1][1])
+        ) or "nessun aggiornamento ricevuto"
+        if stats:
+            top = sorted(
+                ((key, value) for key, value in stats.stats.items() if not self._is_event_loop(*key)),
+                key=lambda item: -item[1][3]
+            )[:self.TOP_N]
+            message += "\n\nFunzioni (tempo cumulativo):\n"
+            message += "\n".join(
+                f"{func} ({os.path.basename(filename)}:{line}): {calls}x, {cumulative * 1000:.1f}ms"
+                for (filename, line, func), (_, calls, _, cumulative, _) in top
+            )
+        message += "\n\nMemoria (diff tracemalloc):\n"
+        message += "\n".join(str(stat) for stat in memory)
+        logging.getLogger().warning(f"{message}\n{stream.getvalue()}")
+
+        await bot.send_message(chat_id=chat_id, text=message[:4096])
+        if stats:
+            fd, path = tempfile.mkstemp(suffix=".pstats")
+            os.close(fd)
+            try:
+                stats.dump_stats(path)
+                with open(path, "rb") as pstats_file:
+                    await bot.send_document(
+                        chat_id=chat_id,
+                        document=pstats_file,
+                        filename="profile.pstats",
+                        caption="Profilo completo, da aprire con pstats o snakeviz",
+                    )
+            finally:
+                os.remove(path)
+
+
+profiler = UpdateProfiler()
+profiled = profiler.profiled